@@ -11,41 +11,84 @@
 # - http://testcluster.blogspot.com/2014/03/scanning-from-escl-device-using-command.html
 
 import argparse
-import datetime
+import hashlib
+import json
 import logging
-import os.path
+import os
+import random
 import requests
 import sys
 import time
-from io import StringIO
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
 from lxml import etree
+from requests.adapters import HTTPAdapter
+from types import MappingProxyType
 from urllib.parse import urljoin
+from urllib3.util.retry import Retry
+from xml.sax.saxutils import escape
 
 DEF_NAME = "scan"
+TYPE_TO_MIME = {"jpg": "image/jpeg", "pdf": "application/pdf"}
+CM_TO_ESCL = {"r24": "RGB24", "g8": "Grayscale8"}
 SIZES = {"a4": (2480, 3508), "a5": (1748, 2480), "b5": (2079, 2953), "us": (2550, 3300)}  # approx. real widths and heights (in mm) times 11.81
-MAX_POLL = 50
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "escl-scan")
+POLL_BASE = 1.3
+POLL_INITIAL = 0.05
+POLL_MAX = 8.0
+POLL_BUDGET_SEC = 120
 NS_SCAN = "http://schemas.hp.com/imaging/escl/2011/05/03"
 NS_PWG = "http://www.pwg.org/schemas/2010/12/sm"
-SCAN_REQUEST = """
+NSMAP = MappingProxyType({"pwg": NS_PWG, "scan": NS_SCAN})
+TAG_VERSION = "{%s}Version" % NS_PWG
+TAG_MAKE_AND_MODEL = "{%s}MakeAndModel" % NS_PWG
+TAG_SERIAL_NUMBER = "{%s}SerialNumber" % NS_PWG
+TAG_DOCUMENT_FORMAT = "{%s}DocumentFormat" % NS_PWG
+TAG_STATE = "{%s}State" % NS_PWG
+TAG_ADMIN_URI = "{%s}AdminURI" % NS_SCAN
+TAG_COLOR_MODE = "{%s}ColorMode" % NS_SCAN
+TAG_X_RESOLUTION = "{%s}XResolution" % NS_SCAN
+TAG_Y_RESOLUTION = "{%s}YResolution" % NS_SCAN
+TAG_MAX_WIDTH = "{%s}MaxWidth" % NS_SCAN
+TAG_MAX_HEIGHT = "{%s}MaxHeight" % NS_SCAN
+PARSER_OPTIONS = {"huge_tree": False, "no_network": True, "resolve_entities": False, "load_dtd": False, "remove_blank_text": True, "collect_ids": False}
+PARSER = etree.XMLParser(**PARSER_OPTIONS)
+XML_CHUNK_SIZE = 64 * 1024
+CAPS_SINGLE = {TAG_VERSION, TAG_MAKE_AND_MODEL, TAG_SERIAL_NUMBER, TAG_ADMIN_URI, TAG_MAX_WIDTH, TAG_MAX_HEIGHT}  # capabilities with a single value, first occurrence wins
+SCAN_REQUEST = [part.encode() for part in ("""
 <?xml version="1.0" encoding="UTF-8"?>
-<scan:ScanSettings xmlns:pwg="__NS_PWG__" xmlns:scan="__NS_SCAN__">
-  <pwg:Version>__VERSION__</pwg:Version>
+<scan:ScanSettings %s>
+  <pwg:Version>{}</pwg:Version>
   <pwg:ScanRegions>
     <pwg:ScanRegion>
       <pwg:XOffset>0</pwg:XOffset>
       <pwg:YOffset>0</pwg:YOffset>
-      <pwg:Width>__WIDTH__</pwg:Width>
-      <pwg:Height>__HEIGHT__</pwg:Height>
+      <pwg:Width>{}</pwg:Width>
+      <pwg:Height>{}</pwg:Height>
       <pwg:ContentRegionUnits>escl:ThreeHundredthsOfInches</pwg:ContentRegionUnits>
     </pwg:ScanRegion>
   </pwg:ScanRegions>
   <pwg:InputSource>Platen</pwg:InputSource>
-  <pwg:DocumentFormat>__FORMAT__</pwg:DocumentFormat>
-  <scan:ColorMode>__COLORMODE__</scan:ColorMode>
-  <scan:XResolution>__RESOLUTION__</scan:XResolution>
-  <scan:YResolution>__RESOLUTION__</scan:YResolution>
+  <pwg:DocumentFormat>{}</pwg:DocumentFormat>
+  <scan:ColorMode>{}</scan:ColorMode>
+  <scan:XResolution>{}</scan:XResolution>
+  <scan:YResolution>{}</scan:YResolution>
 </scan:ScanSettings>
-""".strip()
+""".strip() % " ".join('xmlns:%s="%s"' % ns for ns in NSMAP.items())).split("{}")]  # encoded segments around the values: version, width, height, format, color mode, x- and y-resolution
+
+
+@dataclass(slots=True)
+class Caps:
+    version: str | None
+    makeAndModel: str | None
+    serialNumber: str | None
+    adminUri: str | None
+    formats: frozenset[str]
+    colorModes: frozenset[str]
+    xResolutions: frozenset[int]
+    yResolutions: frozenset[int]
+    maxWidth: int | None
+    maxHeight: int | None
 
 
 def main(args):
@@ -63,122 +106,108 @@ def main(args):
     if args.out != "":
         filename = args.out
     else:
-        filename = DEF_NAME + "_" + str(datetime.datetime.now().strftime("%Y%m%d-%H%M%S")) + "." + args.type
+        filename = "%s_%s.%s" % (DEF_NAME, time.strftime("%Y%m%d-%H%M%S"), args.type)
     if not args.info:
         log.debug("Filename: %s", filename)
         if os.path.isfile(filename):
             error("File exists already: %s" % filename)
 
+    # one persistent connection for all requests, retrying connection errors and gateway failures
+    # (503 is left alone, even with Retry-After, as scanners use it to signal that the result isn't ready yet)
     http = requests.Session()
+    retry = Retry(total=3, backoff_factor=0.3, status_forcelist=(502, 504), respect_retry_after_header=False, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=retry)
+    http.mount("http://", adapter)
+    http.mount("https://", adapter)
 
-    # query capabilities
+    # query capabilities and (unless only showing information) status concurrently
     capUrl = urljoin(args.url, "eSCL/ScannerCapabilities")
-    log.debug("Querying scanner capabilities: %s", capUrl)
-    resp = http.get(capUrl)
-    resp.raise_for_status()
-    tree = etree.fromstring(resp.content)
-    if args.very_verbose:
-        log.debug("Scanner capabilities: %s", str(etree.tostring(tree)).replace("\\n", "\n").replace("\\t", "  "))
-
-    version = first(tree.xpath("//pwg:Version/text()", namespaces={"pwg": NS_PWG}))
-    makeAndModel = first(tree.xpath("//pwg:MakeAndModel/text()", namespaces={"pwg": NS_PWG}))
-    serialNumber = first(tree.xpath("//pwg:SerialNumber/text()", namespaces={"pwg": NS_PWG}))
-    adminUri = first(tree.xpath("//scan:AdminURI/text()", namespaces={"scan": NS_SCAN}))
-    formats = tree.xpath("//pwg:DocumentFormat/text()", namespaces={"pwg": NS_PWG})
-    colorModes = tree.xpath("//scan:ColorMode/text()", namespaces={"scan": NS_SCAN})
-    xResolutions = tree.xpath("//scan:XResolution/text()", namespaces={"scan": NS_SCAN})
-    yResolutions = tree.xpath("//scan:YResolution/text()", namespaces={"scan": NS_SCAN})
-    maxWidth = firstInt(tree.xpath("//scan:MaxWidth/text()", namespaces={"scan": NS_SCAN}))
-    maxHeight = firstInt(tree.xpath("//scan:MaxHeight/text()", namespaces={"scan": NS_SCAN}))
-
-    # query status
     statusUrl = urljoin(args.url, "eSCL/ScannerStatus")
-    log.debug("Querying scanner status: %s", statusUrl)
-    resp = http.get(statusUrl)
-    resp.raise_for_status()
-    tree = etree.fromstring(resp.content)
-    if args.very_verbose:
-        log.debug("Scanner status: %s", str(etree.tostring(tree)).replace("\\n", "\n").replace("\\t", "  "))
-    status = first(tree.xpath("//pwg:State/text()", namespaces={"pwg": NS_PWG}))
-    log.debug("Scanner status: %s", status)
+    pool = ThreadPoolExecutor(max_workers=2)
+    log.debug("Querying scanner capabilities: %s", capUrl)
+    capFuture = pool.submit(queryCapabilities, http, capUrl, args.very_verbose)
+    if not args.info:
+        log.debug("Querying scanner status: %s", statusUrl)
+        statusFuture = pool.submit(queryStatus, http, statusUrl)
+    pool.shutdown(wait=False)
+    caps = capFuture.result()
+    formats = sorted(caps.formats)
+    colorModes = sorted(caps.colorModes)
+    xResolutions = sorted(caps.xResolutions)
+    yResolutions = sorted(caps.yResolutions)
 
     # information
     if args.info:
-        print("Scanner model: %s" % makeAndModel)
-        print("Serial number: %s" % serialNumber)
+        print("Scanner model: %s" % caps.makeAndModel)
+        print("Serial number: %s" % caps.serialNumber)
         print("Scanner URL:   %s" % args.url)
-        print("Admin URL:     %s" % adminUri)
+        print("Admin URL:     %s" % caps.adminUri)
         print("Formats:       %s" % ", ".join(formats))
         print("Color Modes:   %s" % ", ".join(colorModes))
-        print("X-Resolutions: %s" % ", ".join(xResolutions))
-        print("Y-Resolutions: %s" % ", ".join(yResolutions))
-        print("Max width:     %s" % maxWidth)
-        print("Max height:    %s" % maxHeight)
-        print("Status:        %s" % status)
+        print("X-Resolutions: %s" % ", ".join(map(str, xResolutions)))
+        print("Y-Resolutions: %s" % ", ".join(map(str, yResolutions)))
+        print("Max width:     %s" % caps.maxWidth)
+        print("Max height:    %s" % caps.maxHeight)
         sys.exit(0)
 
+    # status
+    tree = statusFuture.result()
+    if args.very_verbose and log.isEnabledFor(logging.DEBUG):
+        log.debug("Scanner status:\n%s", etree.tostring(tree, pretty_print=True).decode())
+    status = firstText(tree, TAG_STATE)
+    log.debug("Scanner status: %s", status)
+
     # format
-    if args.type == "jpg":
-        format = "image/jpeg"
-    elif args.type == "pdf":
-        format = "application/pdf"
-    else:
-        error("Invalid type: %s" % args.type)  # should never happen due to argparse
+    format = TYPE_TO_MIME[args.type]
     log.debug("Format: '%s', supported: %s", format, formats)
-    if format not in formats:
+    if format not in caps.formats:
         error("Unsupported format: '%s', supported: %s" % (format, formats))
 
     # color mode
-    if args.color_mode == "r24":
-        colorMode = "RGB24"
-    elif args.color_mode == "g8":
-        colorMode = "Grayscale8"
-    else:
-        error("Invalid color mode: %s" % args.color_mode)  # should never happen due to argparse
+    colorMode = CM_TO_ESCL[args.color_mode]
     log.debug("Color mode: '%s', supported: %s", colorMode, colorModes)
-    if colorMode not in colorModes:
+    if colorMode not in caps.colorModes:
         error("Unsupported color mode: '%s', supported: %s" % (colorMode, colorModes))
 
     # resolution
-    if args.resolution == '':
-        resolution = max([value for value in xResolutions if value in yResolutions])
+    if args.resolution is None:
+        common = caps.xResolutions & caps.yResolutions
+        if not common:
+            error("No common x- and y-resolution, supported X: %s, supported Y: %s" % (xResolutions, yResolutions))
+        resolution = max(common)
     else:
         resolution = args.resolution
     log.debug("Resolution: %s, supported X: %s, supported Y: %s", resolution, xResolutions, yResolutions)
-    if resolution not in xResolutions:
+    if resolution not in caps.xResolutions:
         error("Unsupported x-resolution '%s', supported: %s" % (resolution, xResolutions))
-    if resolution not in yResolutions:
+    if resolution not in caps.yResolutions:
         error("Unsupported y-resolution '%s', supported: %s" % (resolution, yResolutions))
 
     # width/height
     if args.size == "max":
-        width = maxWidth
-        height = maxHeight
+        width = caps.maxWidth
+        height = caps.maxHeight
     else:
         (width, height) = SIZES[args.size]
-    if width > maxWidth:
-        error("Invalid width: %d, maximum: %d" % (width, maxWidth))
-    if height > maxHeight:
-        error("Invalid height: %d, maximum: %d" % (height, maxHeight))
-    log.debug("Width: %d, maxWidth: %d", width, maxWidth)
-    log.debug("Height: %d, maxHeight: %d", height, maxHeight)
+    if width > caps.maxWidth:
+        error("Invalid width: %d, maximum: %d" % (width, caps.maxWidth))
+    if height > caps.maxHeight:
+        error("Invalid height: %d, maximum: %d" % (height, caps.maxHeight))
+    log.debug("Width: %d, maxWidth: %d", width, caps.maxWidth)
+    log.debug("Height: %d, maxHeight: %d", height, caps.maxHeight)
 
     # start scanning
-    log.debug("Version: %s", version)
+    log.debug("Version: %s", caps.version)
     if status != "Idle":
         error("Invalid scanner status: %s" % status)
     startUrl = urljoin(args.url, "eSCL/ScanJobs")
-    startReq = SCAN_REQUEST.replace(
-        "__NS_SCAN__", NS_SCAN).replace(
-        "__NS_PWG__", NS_PWG).replace(
-        "__VERSION__", version).replace(
-        "__FORMAT__", format).replace(
-        "__COLORMODE__", colorMode).replace(
-        "__RESOLUTION__", resolution).replace(
-        "__WIDTH__", str(width)).replace(
-        "__HEIGHT__", str(height))
+    values = (escape(caps.version), str(width), str(height), format, colorMode, str(resolution), str(resolution))
+    parts = [SCAN_REQUEST[0]]
+    for value, part in zip(values, SCAN_REQUEST[1:]):
+        parts += (value.encode(), part)
+    startReq = b"".join(parts)
     if args.very_verbose:
-        log.debug("Sending scan request to %s: %s", startUrl, startReq)
+        log.debug("Sending scan request to %s: %s", startUrl, startReq.decode())
     else:
         log.debug("Sending scan request: %s", startUrl)
     resp = http.post(startUrl, startReq, headers={"Content-Type": "text/xml"})
@@ -186,33 +215,131 @@ def main(args):
     resultUrl = urljoin(resp.headers["Location"] + "/", "NextDocument")  # status code is 201 so Requests won't follow Location
     log.debug("Result is at %s", resultUrl)
 
-    # poll for the result every two seconds, give up after 10 failures
+    # poll for the result with exponential backoff and jitter, give up after the time budget is spent
     counter = 1
+    delay = POLL_INITIAL
+    deadline = time.monotonic() + POLL_BUDGET_SEC
     while True:
-        time.sleep(2)
+        time.sleep(delay * (0.5 + random.random() * 0.5))
+        delay = min(delay * POLL_BASE, POLL_MAX)
         log.debug("Polling [%d]: %s", counter, resultUrl)
-        resp = http.get(resultUrl)
+        resp = http.get(resultUrl, stream=True)
         if resp.status_code == 200:
             log.debug("Received result")
             break
+        resp.raw.drain_conn()  # read the small error body, so the connection is returned to the pool
         counter += 1
-        if counter > MAX_POLL:
-            error("Giving up after %d attempts to load result, try it manually later: curl -s %s > %s" % (MAX_POLL, resultUrl, filename))
+        if time.monotonic() > deadline:
+            error("Giving up after %d seconds to load result, try it manually later: curl -s %s > %s" % (POLL_BUDGET_SEC, resultUrl, filename))
 
-    # write result
+    # write result, streaming it in chunks into a temporary file that only replaces the target once complete
     log.debug("Writing: %s", filename)
-    with open(filename, "wb") as f:
-        f.write(resp.content)
+    partname = filename + ".part"
+    try:
+        with resp, open(partname, "wb") as f:
+            for chunk in resp.iter_content(1 << 20):
+                f.write(chunk)
+    except requests.RequestException as e:
+        os.remove(partname)
+        error("Failed to load result (%s), try it manually later: curl -s %s > %s" % (e, resultUrl, filename))
+    os.replace(partname, filename)
     print(filename)
 
 
-def first(a, default=None):
-    return a[0] if a else default
+def queryCapabilities(http, url, verbose=False):
+    # revalidate cached capabilities, they only change with the scanner's firmware
+    # (when verbose, always download them to be able to log the whole document)
+    cacheFile = os.path.join(CACHE_DIR, hashlib.sha1(url.encode()).hexdigest() + ".json")
+    cached, cachedCaps = (None, None) if verbose else loadCache(cacheFile)
+    headers = {}
+    if cached and cached.get("etag"):
+        headers["If-None-Match"] = cached["etag"]
+    if cached and cached.get("lastModified"):
+        headers["If-Modified-Since"] = cached["lastModified"]
+
+    # single pass over the document while it arrives, collecting multi-valued capabilities in lists
+    caps = {TAG_DOCUMENT_FORMAT: [], TAG_COLOR_MODE: [], TAG_X_RESOLUTION: [], TAG_Y_RESOLUTION: []}
+    parser = etree.XMLPullParser(events=("end",), **PARSER_OPTIONS)
+    received = [] if verbose else None
+    with http.get(url, headers=headers, stream=True) as resp:
+        if resp.status_code == 304 and cachedCaps:
+            return cachedCaps
+        resp.raise_for_status()
+        etag = resp.headers.get("ETag")
+        lastModified = resp.headers.get("Last-Modified")
+        for _, el in pullEvents(parser, resp.iter_content(XML_CHUNK_SIZE), received):
+            if el.tag in caps:
+                caps[el.tag].append(el.text)
+            elif el.tag in CAPS_SINGLE:
+                caps.setdefault(el.tag, el.text)
+            el.clear()
+    if verbose:
+        logging.getLogger("scan").debug("Scanner capabilities:\n%s", b"".join(received).decode(errors="replace"))
+    caps = Caps(
+        version=caps.get(TAG_VERSION),
+        makeAndModel=caps.get(TAG_MAKE_AND_MODEL),
+        serialNumber=caps.get(TAG_SERIAL_NUMBER),
+        adminUri=caps.get(TAG_ADMIN_URI),
+        formats=frozenset(caps[TAG_DOCUMENT_FORMAT]),
+        colorModes=frozenset(caps[TAG_COLOR_MODE]),
+        xResolutions=frozenset(map(int, caps[TAG_X_RESOLUTION])),
+        yResolutions=frozenset(map(int, caps[TAG_Y_RESOLUTION])),
+        maxWidth=toInt(caps.get(TAG_MAX_WIDTH)),
+        maxHeight=toInt(caps.get(TAG_MAX_HEIGHT)))
+    if etag or lastModified:
+        saveCache(cacheFile, {"etag": etag, "lastModified": lastModified, "caps": asdict(caps)})
+    return caps
+
+
+def queryStatus(http, url):
+    with http.get(url, stream=True) as resp:
+        resp.raise_for_status()
+        resp.raw.decode_content = True
+        return etree.parse(resp.raw, PARSER).getroot()
+
+
+def loadCache(path):
+    try:
+        with open(path) as f:
+            cached = json.load(f)
+        caps = cached["caps"]
+        return cached, Caps(**dict(
+            caps,
+            formats=frozenset(caps["formats"]),
+            colorModes=frozenset(caps["colorModes"]),
+            xResolutions=frozenset(caps["xResolutions"]),
+            yResolutions=frozenset(caps["yResolutions"])))
+    except (OSError, ValueError, KeyError, TypeError):
+        return None, None
+
+
+def saveCache(path, cached):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            json.dump(cached, f, default=sorted)  # frozensets are stored as sorted lists
+        os.replace(path + ".tmp", path)
+    except OSError:
+        pass  # the cache is only an optimization
+
+
+def pullEvents(parser, chunks, received=None):
+    for chunk in chunks:
+        if received is not None:
+            received.append(chunk)
+        parser.feed(chunk)
+        yield from parser.read_events()
+    parser.close()
+    yield from parser.read_events()
+
+
+def firstText(tree, tag, default=None):
+    el = next(tree.iter(tag), None)
+    return el.text if el is not None else default
 
 
-def firstInt(a, default=None):
-    f = first(a)
-    return int(f) if f else default
+def toInt(s, default=None):
+    return int(s) if s else default
 
 
 def error(msg):
@@ -224,9 +351,9 @@ if __name__ == "__main__":
     ap = argparse.ArgumentParser(description="A little Python3 script for scanning via the eSCL protocol")
     ap.add_argument("-i", "--info", action="store_true", help="show scanner information and exit")
     ap.add_argument("-o", "--out", default="", help="output file name [default: " + DEF_NAME + "_<datetime>.<type>]")
-    ap.add_argument("-t", "--type", default="jpg", help="desired resulting file type [default: %(default)s]", choices=["jpg", "pdf"])
-    ap.add_argument("-r", "--resolution", default="", help="a single value for both X and Y resolution [default: max. available]")
-    ap.add_argument("-c", "--color-mode", default="r24", help="RGB24 (r24) or Grayscale8 (g8) [default: %(default)s]", choices=["r24", "g8"])
+    ap.add_argument("-t", "--type", default="jpg", help="desired resulting file type [default: %(default)s]", choices=list(TYPE_TO_MIME))
+    ap.add_argument("-r", "--resolution", type=int, help="a single value for both X and Y resolution [default: max. available]")
+    ap.add_argument("-c", "--color-mode", default="r24", help="RGB24 (r24) or Grayscale8 (g8) [default: %(default)s]", choices=list(CM_TO_ESCL))
     ap.add_argument("-s", "--size", default="max", help="size of scanned paper [default: %(default)s]", choices=["a4", "a5", "b5", "us", "max"])
     ap.add_argument("-v", "--verbose", action="store_true", help="Show debug output")
     ap.add_argument("-V", "--very-verbose", action="store_true", help="Show debug output and all data")